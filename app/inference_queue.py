@@ -0,0 +1,88 @@
+import asyncio
+import os
+import time
+from app.yolo_detector import detect_food_batch, empty_result, DEADLINE_EXCEEDED
+
+# Micro-batching: tunggu sampai MAX_BATCH item atau MAX_WAIT_MS.
+# Window lebih lebar = batch lebih penuh di bawah beban, tapi menambah
+# latency request tunggal sebesar maksimal MAX_WAIT_MS.
+MAX_BATCH = int(os.getenv("INFER_MAX_BATCH", "8"))
+MAX_WAIT_MS = float(os.getenv("INFER_BATCH_WAIT_MS", "20"))
+
+_queue = None
+_worker_task = None
+
+async def start_batcher():
+    """Jalankan satu inference worker untuk seluruh proses"""
+    global _queue, _worker_task
+    if _worker_task is None:
+        _queue = asyncio.Queue()
+        _worker_task = asyncio.create_task(_batch_worker())
+
+async def stop_batcher():
+    """Hentikan worker saat shutdown"""
+    global _worker_task
+    if _worker_task is not None:
+        _worker_task.cancel()
+        try:
+            await _worker_task
+        except asyncio.CancelledError:
+            pass
+        _worker_task = None
+
+async def detect_async(image, deadline=None):
+    """Masukkan gambar ke antrian dan tunggu hasil deteksinya.
+    
+    deadline: time.monotonic() terakhir yang masih layak diproses.
+    """
+    future = asyncio.get_running_loop().create_future()
+    await _queue.put((image, future, deadline))
+    return await future
+
+def _drop_abandoned(batch):
+    """Buang item yang caller-nya sudah pergi atau lewat deadline"""
+    now = time.monotonic()
+    live = []
+    for image, future, deadline in batch:
+        if future.done():
+            # Caller dibatalkan (client disconnect): future ikut cancelled
+            continue
+        if deadline is not None and now > deadline:
+            future.set_result(empty_result(DEADLINE_EXCEEDED))
+            continue
+        live.append((image, future, deadline))
+    return live
+
+async def _collect_batch():
+    """Ambil item pertama, lalu kumpulkan sisanya sampai penuh / timeout"""
+    loop = asyncio.get_running_loop()
+    batch = [await _queue.get()]
+    deadline = loop.time() + MAX_WAIT_MS / 1000
+    
+    while len(batch) < MAX_BATCH:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(_queue.get(), timeout))
+        except asyncio.TimeoutError:
+            break
+    return batch
+
+async def _batch_worker():
+    while True:
+        batch = _drop_abandoned(await _collect_batch())
+        if not batch:
+            continue
+        images = [image for image, _, _ in batch]
+        
+        try:
+            # Satu forward pass untuk seluruh batch, di luar event loop
+            results = await asyncio.to_thread(detect_food_batch, images)
+        except Exception as e:
+            print(f"❌ Batch worker error: {e}")
+            results = [empty_result(str(e)) for _ in batch]
+        
+        for (_, future, _), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
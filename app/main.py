@@ -1,81 +1,137 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, HTMLResponse
+from fastapi.responses import ORJSONResponse, HTMLResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-import shutil
 import os
-import uuid
+import hashlib
 import asyncio
+import logging
 import time
-from app.yolo_detector import detect_food_optimized, warmup_model
-from app.mistral_service import ask_mistral_async
+from time import perf_counter_ns
+from app.yolo_detector import warmup_model, DEADLINE_EXCEEDED
+from app.inference_queue import start_batcher, stop_batcher, detect_async, MAX_BATCH
+from app.mistral_service import (
+    ask_mistral_async, stream_mistral, create_async_client,
+    load_semantic_cache
+)
 from app.nutrition_advisor import build_comprehensive_prompt
-import json
+from app.utils import decode_image
+from app.schemas import PredictResponse
+import orjson
 import concurrent.futures
 
+# Log per request hanya muncul jika LOG_LEVEL=INFO (default WARNING)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING").upper())
+logger = logging.getLogger(__name__)
+
 app = FastAPI(
     title="Yareusnap AI Food Detection API",
     description="Optimized AI-powered food detection and nutrition analysis system",
-    version="3.0.0"
+    version="3.0.0",
+    default_response_class=ORJSONResponse
 )
 
-# CORS middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# CORS middleware: allowlist dari env, wildcard hanya untuk DEV.
+# Halaman "/" same-origin, jadi tanpa allowlist middleware tidak dipasang sama sekali.
+CORS_ORIGINS = [o.strip() for o in os.getenv("CORS_ORIGINS", "").split(",") if o.strip()]
+
+if os.getenv("DEV"):
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+elif CORS_ORIGINS:
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=CORS_ORIGINS,
+        allow_methods=["GET", "POST"],
+        allow_headers=["content-type"],
+    )
+
+# Halaman test di-load sekali sebagai bytes, plus ETag untuk 304
+HOME_HTML_PATH = os.path.join(os.path.dirname(__file__), "..", "static", "sample_test.html")
+with open(HOME_HTML_PATH, "rb") as f:
+    _HOME_HTML_BYTES = f.read()
+_HOME_ETAG = f'"{hashlib.blake2b(_HOME_HTML_BYTES).hexdigest()[:16]}"'
+_HOME_HEADERS = {"Cache-Control": "public, max-age=3600", "ETag": _HOME_ETAG}
 
-UPLOAD_DIR = "uploads"
-os.makedirs(UPLOAD_DIR, exist_ok=True)
+# Batas waktu antri + inference; lewat dari ini hasilnya dibuang
+DETECTION_TIMEOUT_S = float(os.getenv("DETECTION_TIMEOUT_S", "10"))
 
-# Thread pool untuk parallel processing
+# Thread pool untuk decode gambar; inference lewat satu worker (inference_queue)
 thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4)
 
 @app.on_event("startup")
 async def startup_event():
     """Warm up model saat startup"""
     print("🚀 Warming up YOLO model...")
-    warmup_model()
+    warmup_model(batch_sizes=(1, MAX_BATCH))
     print("✅ Model warmed up and ready!")
+    await start_batcher()
+    # Satu client Mistral per event loop worker
+    app.state.mistral_client = create_async_client()
+    await asyncio.to_thread(load_semantic_cache)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Tutup koneksi Mistral dan inference worker saat shutdown"""
+    await stop_batcher()
+    await app.state.mistral_client.aclose()
+
+@app.get("/", response_class=HTMLResponse)
+async def home(request: Request):
+    """Halaman upload sederhana untuk testing /predict"""
+    if request.headers.get("if-none-match") == _HOME_ETAG:
+        return Response(status_code=304, headers=_HOME_HEADERS)
+    return Response(content=_HOME_HTML_BYTES, media_type="text/html", headers=_HOME_HEADERS)
+
+async def detect_for_request(request: Request, image, raise_on_timeout=True):
+    """Deteksi via batcher dengan deadline; skip jika client sudah disconnect"""
+    if await request.is_disconnected():
+        raise HTTPException(status_code=499, detail="Client disconnected")
+    result = await detect_async(image, time.monotonic() + DETECTION_TIMEOUT_S)
+    
+    # Server kelebihan beban: jangan jawab "tidak terdeteksi" dengan status 200
+    if raise_on_timeout and result.get("error") == DEADLINE_EXCEEDED:
+        raise HTTPException(status_code=504, detail="Detection timed out, server busy")
+    return result
 
-@app.post("/predict")
-async def predict(file: UploadFile = File(...)):
+async def read_upload_image(file: UploadFile):
+    """Baca upload ke memory dan decode ke ndarray, tanpa menulis ke disk"""
+    # UploadFile sudah SpooledTemporaryFile: upload kecil tetap di RAM
+    raw = await file.read()
+    
+    return await asyncio.get_event_loop().run_in_executor(
+        thread_pool,
+        decode_image,
+        raw
+    )
+
+@app.post("/predict", response_model=PredictResponse)
+async def predict(request: Request, file: UploadFile = File(...)):
     """Endpoint utama yang sudah dioptimalkan"""
-    start_time = time.time()
+    start_ns = perf_counter_ns()
     
     try:
         # Validasi file cepat
         if not file.filename or not file.content_type.startswith('image/'):
             raise HTTPException(status_code=400, detail="File gambar diperlukan")
         
-        # Generate unique filename
-        file_extension = os.path.splitext(file.filename)[1]
-        unique_filename = f"{uuid.uuid4()}{file_extension}"
-        save_path = f"{UPLOAD_DIR}/{unique_filename}"
-        
-        # Save file dengan chunk reading untuk memory efficiency
-        with open(save_path, "wb") as f:
-            shutil.copyfileobj(file.file, f)
-        
-        upload_time = time.time() - start_time
-        print(f"📨 File uploaded in {upload_time:.2f}s: {file.filename}")
+        # Decode langsung di memory (tanpa round-trip disk)
+        image = await read_upload_image(file)
+        if image is None:
+            raise HTTPException(status_code=400, detail="Gambar tidak valid")
         
-        # Parallel processing: detection dan Mistral analysis
-        detection_start = time.time()
+        detection_start_ns = perf_counter_ns()
+        upload_time = (detection_start_ns - start_ns) / 1e9
         
-        # Run detection in thread pool
-        detection_future = asyncio.get_event_loop().run_in_executor(
-            thread_pool, 
-            detect_food_optimized, 
-            save_path
-        )
-        detection_result = await detection_future
+        # Detection lewat micro-batching worker
+        detection_result = await detect_for_request(request, image)
         
-        detection_time = time.time() - detection_start
-        print(f"🎯 Detection completed in {detection_time:.2f}s")
+        mistral_start_ns = perf_counter_ns()
+        detection_time = (mistral_start_ns - detection_start_ns) / 1e9
         
         detected_foods = detection_result["detected_foods"]
         detections = detection_result["detections"]
@@ -83,26 +139,31 @@ async def predict(file: UploadFile = File(...)):
         # Mistral analysis hanya jika ada deteksi
         mistral_analysis = {}
         if detected_foods and len(detected_foods) > 0:
-            mistral_start = time.time()
             prompt = build_comprehensive_prompt(detected_foods, detections)
             
             # Run Mistral async
-            mistral_response = await ask_mistral_async(prompt)
+            mistral_response = await ask_mistral_async(
+                prompt,
+                request.app.state.mistral_client,
+                detected_foods
+            )
             mistral_analysis = parse_mistral_response(mistral_response)
-            
-            mistral_time = time.time() - mistral_start
-            print(f"🤖 Mistral analysis in {mistral_time:.2f}s")
         else:
             mistral_analysis = get_fallback_analysis()
         
-        # Clean up
-        try:
-            os.remove(save_path)
-        except:
-            pass
+        end_ns = perf_counter_ns()
+        total_time = (end_ns - start_ns) / 1e9
         
-        total_time = time.time() - start_time
-        print(f"✅ Total processing time: {total_time:.2f}s")
+        # Satu baris log per request; format ditunda sampai level aktif
+        logger.info(
+            "predict %s total=%.2fms upload=%.2fms det=%.2fms mistral=%.2fms foods=%d",
+            file.filename,
+            (end_ns - start_ns) / 1e6,
+            upload_time * 1e3,
+            detection_time * 1e3,
+            (end_ns - mistral_start_ns) / 1e6,
+            len(detected_foods),
+        )
         
         return {
             "success": True,
@@ -119,37 +180,68 @@ async def predict(file: UploadFile = File(...)):
             "message": f"Detected {len(detected_foods)} food items in {total_time:.2f}s"
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"❌ Error in prediction: {e}")
+        logger.exception("Error in prediction")
         raise HTTPException(status_code=500, detail=f"Prediction failed: {str(e)}")
 
+def _sse(event, data):
+    """Format satu event Server-Sent Events; data sudah berupa JSON bytes"""
+    return b"event: " + event.encode() + b"\ndata: " + data + b"\n\n"
+
+async def _predict_event_stream(detection_result, client):
+    """Kirim hasil deteksi dulu, lalu token analisis Mistral satu per satu"""
+    detected_foods = detection_result["detected_foods"]
+    detections = detection_result["detections"]
+    
+    yield _sse("detection", orjson.dumps({
+        "detected_foods": detected_foods,
+        "detections": detections
+    }))
+    
+    if not detected_foods:
+        yield _sse("analysis", orjson.dumps(get_fallback_analysis()))
+    else:
+        prompt = build_comprehensive_prompt(detected_foods, detections)
+        try:
+            async for chunk in stream_mistral(prompt, client, detected_foods):
+                yield _sse("token", orjson.dumps(chunk))
+        except Exception as e:
+            logger.warning("Mistral stream error: %s", e)
+            yield _sse("error", orjson.dumps(str(e)))
+    
+    yield _sse("done", b"{}")
+
+@app.post("/predict-stream")
+async def predict_stream(request: Request, file: UploadFile = File(...)):
+    """Seperti /predict, tapi analisis Mistral di-stream via SSE"""
+    if not file.filename or not file.content_type.startswith('image/'):
+        raise HTTPException(status_code=400, detail="File gambar diperlukan")
+    
+    image = await read_upload_image(file)
+    if image is None:
+        raise HTTPException(status_code=400, detail="Gambar tidak valid")
+    
+    detection_result = await detect_for_request(request, image)
+    
+    return StreamingResponse(
+        _predict_event_stream(detection_result, request.app.state.mistral_client),
+        media_type="text/event-stream"
+    )
+
 @app.post("/fast-predict")
-async def fast_predict(file: UploadFile = File(...)):
+async def fast_predict(request: Request, file: UploadFile = File(...)):
     """Endpoint ultra-cepat tanpa Mistral analysis"""
-    start_time = time.time()
+    start_ns = perf_counter_ns()
     
     try:
-        # Save file
-        unique_filename = f"{uuid.uuid4()}_{file.filename}"
-        save_path = f"{UPLOAD_DIR}/{unique_filename}"
-        
-        with open(save_path, "wb") as f:
-            shutil.copyfileobj(file.file, f)
+        image = await read_upload_image(file)
         
         # Fast detection only
-        detection_result = await asyncio.get_event_loop().run_in_executor(
-            thread_pool, 
-            detect_food_optimized, 
-            save_path
-        )
-        
-        # Clean up
-        try:
-            os.remove(save_path)
-        except:
-            pass
+        detection_result = await detect_for_request(request, image)
         
-        total_time = time.time() - start_time
+        total_time = (perf_counter_ns() - start_ns) / 1e9
         
         return {
             "success": True,
@@ -159,27 +251,46 @@ async def fast_predict(file: UploadFile = File(...)):
             "message": f"Fast detection completed in {total_time:.2f}s"
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Fast prediction failed: {str(e)}")
 
 @app.post("/batch-predict")
-async def batch_predict(files: list[UploadFile] = File(...)):
+async def batch_predict(request: Request, files: list[UploadFile] = File(...)):
     """Endpoint untuk batch processing multiple images"""
     if len(files) > 10:
         raise HTTPException(status_code=400, detail="Maximum 10 files allowed")
     
-    start_time = time.time()
-    results = []
+    start_ns = perf_counter_ns()
     
-    # Process files in parallel
-    tasks = []
-    for file in files:
-        task = asyncio.create_task(process_single_file(file))
-        tasks.append(task)
+    # Baca + decode semua upload secara paralel
+    images = await asyncio.gather(
+        *(read_upload_image(file) for file in files),
+        return_exceptions=True
+    )
+    images = [None if isinstance(img, Exception) else img for img in images]
     
-    results = await asyncio.gather(*tasks, return_exceptions=True)
+    # Worker menggabungkan gambar ke batched forward pass
+    detection_results = await asyncio.gather(
+        *(detect_for_request(request, image, raise_on_timeout=False) for image in images)
+    )
     
-    total_time = time.time() - start_time
+    results = []
+    for file, detection_result in zip(files, detection_results):
+        if detection_result.get("error"):
+            results.append({
+                "filename": file.filename,
+                "error": detection_result["error"]
+            })
+        else:
+            results.append({
+                "filename": file.filename,
+                "detected_foods": detection_result["detected_foods"],
+                "detections": detection_result["detections"]
+            })
+    
+    total_time = (perf_counter_ns() - start_ns) / 1e9
     
     return {
         "success": True,
@@ -189,66 +300,30 @@ async def batch_predict(files: list[UploadFile] = File(...)):
         "average_time": f"{total_time/len(files):.2f}s per image"
     }
 
-async def process_single_file(file: UploadFile):
-    """Process single file untuk batch processing"""
-    try:
-        # Save file
-        unique_filename = f"{uuid.uuid4()}_{file.filename}"
-        save_path = f"{UPLOAD_DIR}/{unique_filename}"
-        
-        with open(save_path, "wb") as f:
-            shutil.copyfileobj(file.file, f)
-        
-        # Fast detection
-        detection_result = await asyncio.get_event_loop().run_in_executor(
-            thread_pool, 
-            detect_food_optimized, 
-            save_path
-        )
-        
-        # Clean up
-        try:
-            os.remove(save_path)
-        except:
-            pass
-        
-        return {
-            "filename": file.filename,
-            "detected_foods": detection_result["detected_foods"],
-            "detections": detection_result["detections"]
-        }
-        
-    except Exception as e:
-        return {
-            "filename": file.filename,
-            "error": str(e)
-        }
-
 @app.get("/health")
 async def health_check():
-    """Health check dengan performance metrics"""
+    """Health check ringan: tanpa inference, cukup status warmup"""
     try:
-        from app.yolo_detector import model, get_model_info
-        from app.mistral_service import test_mistral_connection
+        from app import yolo_detector
+        from app.mistral_service import MISTRAL_KEY
         
-        model_info = get_model_info()
-        mistral_status, mistral_message = test_mistral_connection()
+        if not yolo_detector.MODEL_READY:
+            return {
+                "status": "starting",
+                "model": "warming up"
+            }
         
-        # Test detection speed dengan sample image
-        test_image = np.ones((320, 320, 3), dtype=np.uint8) * 255
-        cv2.rectangle(test_image, (100, 100), (220, 220), (0, 255, 0), -1)
-        
-        test_start = time.time()
-        _ = model(test_image, conf=0.25, imgsz=320, verbose=False)
-        test_time = time.time() - test_start
+        model_info = yolo_detector.get_model_info()
         
         return {
             "status": "healthy",
             "service": "Optimized Food Detection API",
-            "model": "loaded",
+            "model": "ready",
             "model_classes": model_info["classes_count"],
-            "inference_speed": f"{test_time:.3f}s",
-            "mistral_ai": mistral_status,
+            "model_path": model_info["model_path"],
+            "fp16": model_info["fp16"],
+            # Tanpa call ke Mistral (berbayar); cek live ada di /health/mistral
+            "mistral_ai": "configured" if MISTRAL_KEY else "disabled",
             "thread_pool": "active",
             "version": "3.0.0"
         }
@@ -258,6 +333,18 @@ async def health_check():
             "error": str(e)
         }
 
+@app.get("/health/mistral")
+async def mistral_health_check():
+    """Diagnostik manual: satu request nyata ke Mistral (jangan dipakai sebagai probe)"""
+    from app.mistral_service import test_mistral_connection
+    
+    # Request sync (httpx.Client) dijalankan di thread, bukan di event loop
+    mistral_status, mistral_message = await asyncio.to_thread(test_mistral_connection)
+    return {
+        "mistral_ai": mistral_status,
+        "message": mistral_message
+    }
+
 @app.get("/performance")
 async def performance_stats():
     """Endpoint untuk melihat performance statistics"""
@@ -283,52 +370,61 @@ async def performance_stats():
 
 # ... (rest of the endpoints and HTML response remain similar)
 
+# Fallback statis dibangun sekali saat import dan dipakai bersama.
+# Caller hanya membaca/serialize, jangan dimodifikasi.
+_PARSE_FALLBACK = {
+    "food_type": "Makanan Terdeteksi",
+    "components": ["Analisis nutrisi tersedia"],
+    "nutrition": {
+        "protein": "Cukup",
+        "carbs": "Cukup", 
+        "fat": "Cukup",
+        "fiber": "Cukup",
+        "vitamins": "Cukup"
+    },
+    "deficiencies": ["Perlu variasi makanan"],
+    "recommendations": [
+        "Konsumsi makanan seimbang",
+        "Perbanyak buah dan sayuran",
+        "Minum air yang cukup"
+    ]
+}
+
+_NO_DETECTION_FALLBACK = {
+    "food_type": "Tidak Terdeteksi",
+    "components": [],
+    "nutrition": {
+        "protein": "Tidak Diketahui",
+        "carbs": "Tidak Diketahui", 
+        "fat": "Tidak Diketahui",
+        "fiber": "Tidak Diketahui",
+        "vitamins": "Tidak Diketahui"
+    },
+    "deficiencies": ["Gambar tidak jelas atau tidak ada makanan"],
+    "recommendations": [
+        "Pastikan makanan terlihat jelas",
+        "Gunakan pencahayaan yang baik",
+        "Foto dari sudut yang berbeda"
+    ]
+}
+
 def parse_mistral_response(response_text):
-    """Optimized response parsing"""
+    """Mistral dipaksa output JSON, jadi cukup satu orjson.loads"""
     try:
-        if response_text.strip().startswith('{'):
-            return json.loads(response_text)
-    except:
-        pass
+        parsed = orjson.loads(response_text)
+    except orjson.JSONDecodeError:
+        parsed = None
     
-    # Fast fallback parsing
-    return {
-        "food_type": "Makanan Terdeteksi",
-        "components": ["Analisis nutrisi tersedia"],
-        "nutrition": {
-            "protein": "Cukup",
-            "carbs": "Cukup", 
-            "fat": "Cukup",
-            "fiber": "Cukup",
-            "vitamins": "Cukup"
-        },
-        "deficiencies": ["Perlu variasi makanan"],
-        "recommendations": [
-            "Konsumsi makanan seimbang",
-            "Perbanyak buah dan sayuran",
-            "Minum air yang cukup"
-        ]
-    }
+    # nutrition_analysis harus objek; list/string/angka tidak lolos schema
+    if isinstance(parsed, dict):
+        return parsed
+    
+    # Safety net jika output tetap bukan JSON
+    return _PARSE_FALLBACK
 
 def get_fallback_analysis():
     """Fast fallback ketika tidak ada deteksi"""
-    return {
-        "food_type": "Tidak Terdeteksi",
-        "components": [],
-        "nutrition": {
-            "protein": "Tidak Diketahui",
-            "carbs": "Tidak Diketahui", 
-            "fat": "Tidak Diketahui",
-            "fiber": "Tidak Diketahui",
-            "vitamins": "Tidak Diketahui"
-        },
-        "deficiencies": ["Gambar tidak jelas atau tidak ada makanan"],
-        "recommendations": [
-            "Pastikan makanan terlihat jelas",
-            "Gunakan pencahayaan yang baik",
-            "Foto dari sudut yang berbeda"
-        ]
-    }
+    return _NO_DETECTION_FALLBACK
 
 if __name__ == "__main__":
     import uvicorn
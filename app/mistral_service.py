@@ -1,73 +1,401 @@
-import requests
 import os
-import json
-import aiohttp
+import orjson
+import hashlib
+import httpx
 import asyncio
 import time
+import numpy as np
+from cachetools import TTLCache
+from app.nutrition_advisor import SYSTEM_PREFIX
 
 MISTRAL_KEY = os.getenv("MISTRAL_API_KEY")
 MISTRAL_URL = "https://api.mistral.ai/v1/chat/completions"
 
-# Async session for better performance
-async_session = None
+CACHE_TTL = 3600             # Detik
+REDIS_URL = os.getenv("REDIS_URL")  # Opsional: cache bersama antar worker/proses
+SEMANTIC_THRESHOLD = 0.92    # Cosine similarity minimum untuk semantic hit
+SEMANTIC_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+SEMANTIC_ONNX_FILE = "onnx/model_quint8_avx2.onnx"  # int8, cepat di CPU
+SEMANTIC_MAX_ENTRIES = 4096
 
-def get_async_session():
-    """Get or create async session"""
-    global async_session
-    if async_session is None:
-        async_session = aiohttp.ClientSession()
-    return async_session
+# Micro-batching beberapa prompt ke satu call Mistral (opt-in, menambah latency)
+MISTRAL_BATCHING = os.getenv("MISTRAL_BATCHING") == "1"
+MISTRAL_MAX_BATCH = 8
+MISTRAL_BATCH_WAIT_MS = 250
+MAX_TOKENS = 800  # Reduced for speed
 
-async def ask_mistral_async(prompt):
-    """Async Mistral API call"""
-    if not MISTRAL_KEY:
-        return get_fallback_response()
+def _headers():
+    return {
+        "Authorization": f"Bearer {MISTRAL_KEY}",
+        "Content-Type": "application/json"
+    }
+
+def create_async_client():
+    """Async client untuk satu event loop; dibuat saat startup, ditutup saat shutdown"""
+    return httpx.AsyncClient(
+        http2=True,
+        headers=_headers(),
+        timeout=httpx.Timeout(15, connect=3),  # Shorter timeout
+        limits=httpx.Limits(
+            max_connections=100,
+            max_keepalive_connections=32,
+            keepalive_expiry=60
+        )
+    )
+
+# Client sync HTTP/2: request paralel dari thread berbagi satu koneksi TLS.
+# Retry transport hanya untuk gagal connect (status 429/5xx tidak di-retry)
+_SESSION = httpx.Client(
+    headers=_headers(),
+    timeout=httpx.Timeout(15, connect=3),
+    transport=httpx.HTTPTransport(
+        http2=True,
+        retries=2,
+        limits=httpx.Limits(
+            max_connections=50,
+            max_keepalive_connections=20,
+            keepalive_expiry=60
+        )
+    )
+)
+
+# Level 1: exact cache (set makanan terdeteksi, atau hash prompt)
+_exact = TTLCache(maxsize=4096, ttl=CACHE_TTL)
+_redis = None
+_redis_available = None  # None: belum dicoba
+
+# Singleflight: satu task per key untuk request yang sedang berjalan
+_inflight = {}
+
+# Antrian micro-batching, dibuat saat pertama dipakai
+_batch_queue = None
+_batch_worker_task = None
+_batch_tasks = set()  # Referensi kuat ke task _run_batch yang sedang berjalan
+
+# Level 2: semantic cache (opsional, butuh sentence-transformers + faiss)
+_embedder = None
+_semantic_index = None
+_semantic_entries = []  # (response, expires_at), paralel dengan index
+_semantic_available = None
+
+def _food_str(foods):
+    """Bentuk normal daftar makanan: urutan dan kapitalisasi diabaikan"""
+    return ", ".join(sorted({f.strip().lower() for f in foods}))
+
+def canonical_foods_key(foods):
+    """Key cache yang sama untuk set makanan yang sama, urutan diabaikan"""
+    return hashlib.blake2b(_food_str(foods).encode(), digest_size=16).hexdigest()
+
+def _cache_key(prompt, foods=None):
+    """Key dari set makanan jika ada, selain itu hash dari prompt"""
+    if foods:
+        return canonical_foods_key(foods)
+    return hashlib.blake2b(prompt.encode(), digest_size=16).hexdigest()
+
+def _get_redis():
+    """Client Redis sekali; None jika REDIS_URL kosong atau client gagal dibuat"""
+    global _redis, _redis_available
+    if _redis_available is None:
+        _redis_available = False
+        if REDIS_URL:
+            try:
+                import redis.asyncio as redis
+                _redis = redis.from_url(REDIS_URL, decode_responses=True)
+                _redis_available = True
+            except Exception as e:
+                print(f"⚠️ Redis cache disabled: {e}")
+    return _redis
+
+async def _redis_get(key):
+    client = _get_redis()
+    if client is None:
+        return None
+    try:
+        return await client.get(f"mistral:{key}")
+    except Exception as e:
+        print(f"⚠️ Redis get failed: {e}")
+        return None
+
+async def _redis_set(key, value):
+    client = _get_redis()
+    if client is None:
+        return
+    try:
+        await client.set(f"mistral:{key}", value, ex=CACHE_TTL)
+    except Exception as e:
+        print(f"⚠️ Redis set failed: {e}")
+
+def _load_embedder():
+    from sentence_transformers import SentenceTransformer
+    try:
+        # MiniLM ONNX int8: ~ms per embedding di CPU
+        return SentenceTransformer(
+            SEMANTIC_MODEL,
+            backend="onnx",
+            model_kwargs={"file_name": SEMANTIC_ONNX_FILE}
+        )
+    except Exception as e:
+        print(f"⚠️ ONNX embedder unavailable, using PyTorch: {e}")
+        return SentenceTransformer(SEMANTIC_MODEL)
+
+def load_semantic_cache():
+    """Load MiniLM + FAISS index sekali; False jika dependency tidak ada"""
+    global _embedder, _semantic_index, _semantic_available
+    if _semantic_available is None:
+        try:
+            import faiss
+            _embedder = _load_embedder()
+            _semantic_index = faiss.IndexFlatIP(_embedder.get_sentence_embedding_dimension())
+            _semantic_available = True
+        except Exception as e:
+            print(f"⚠️ Semantic cache disabled: {e}")
+            _semantic_available = False
+    return _semantic_available
+
+def _embed(text):
+    vec = _embedder.encode([text], normalize_embeddings=True)
+    return np.asarray(vec, dtype=np.float32)
+
+def _semantic_lookup(vec):
+    if _semantic_index.ntotal == 0:
+        return None
+    scores, ids = _semantic_index.search(vec, 1)
+    if scores[0][0] < SEMANTIC_THRESHOLD:
+        return None
+    response, expires_at = _semantic_entries[ids[0][0]]
+    if expires_at < time.monotonic():
+        return None
+    return response
+
+def _semantic_store(vec, response):
+    # IndexFlatIP tidak mendukung hapus per item; reset saat penuh
+    if _semantic_index.ntotal >= SEMANTIC_MAX_ENTRIES:
+        _semantic_index.reset()
+        _semantic_entries.clear()
+    _semantic_index.add(vec)
+    _semantic_entries.append((response, time.monotonic() + CACHE_TTL))
+
+def _request_body(prompt, stream=False, max_tokens=MAX_TOKENS):
+    return {
+        "model": "mistral-small-latest",
+        "messages": [
+            {"role": "system", "content": SYSTEM_PREFIX},
+            {"role": "user", "content": prompt}
+        ],
+        "temperature": 0.7,
+        "max_tokens": max_tokens,
+        "response_format": {"type": "json_object"},
+        "stream": stream
+    }
+
+def _is_json_object(text):
+    """Hanya objek JSON yang boleh masuk cache (selain itu response gagal schema)"""
+    try:
+        return isinstance(orjson.loads(text), dict)
+    except orjson.JSONDecodeError:
+        return False
+
+async def _call_mistral(prompt, client):
+    """Raw Mistral API call, raise on error"""
+    response = await client.post(MISTRAL_URL, content=orjson.dumps(_request_body(prompt)))
+    response.raise_for_status()
+    data = orjson.loads(response.content)
+    return data["choices"][0]["message"]["content"]
+
+def _build_batch_prompt(prompts):
+    """Gabungkan N user message jadi satu, minta array hasil dengan urutan sama"""
+    sections = "\n\n".join(f"### {i}\n{p}" for i, p in enumerate(prompts, 1))
+    return (
+        f"Analisis {len(prompts)} set makanan berikut secara terpisah.\n\n"
+        f"{sections}\n\n"
+        f'Kembalikan satu objek JSON {{"results": [...]}} berisi tepat '
+        f"{len(prompts)} objek sesuai format di atas, urutan sama dengan nomor set."
+    )
+
+async def _run_batch(batch):
+    """Satu call Mistral untuk seluruh batch; jika gagal, call satu per satu"""
+    prompts = [prompt for prompt, _, _ in batch]
+    client = batch[0][1]
     
     try:
-        session = get_async_session()
-        
-        headers = {
-            "Authorization": f"Bearer {MISTRAL_KEY}",
-            "Content-Type": "application/json"
-        }
+        if len(batch) == 1:
+            results = [await _call_mistral(prompts[0], client)]
+        else:
+            body = _request_body(_build_batch_prompt(prompts), max_tokens=MAX_TOKENS * len(batch))
+            response = await client.post(MISTRAL_URL, content=orjson.dumps(body))
+            response.raise_for_status()
+            content = orjson.loads(response.content)["choices"][0]["message"]["content"]
+            items = orjson.loads(content)["results"]
+            if len(items) != len(batch):
+                raise ValueError(f"expected {len(batch)} results, got {len(items)}")
+            if not all(isinstance(item, dict) for item in items):
+                raise ValueError("batch results must be JSON objects")
+            results = [orjson.dumps(item).decode() for item in items]
+    except Exception as e:
+        if len(batch) == 1:
+            results = [e]
+        else:
+            print(f"⚠️ Mistral batch failed, retrying individually: {e}")
+            results = await asyncio.gather(
+                *(_call_mistral(p, client) for p in prompts),
+                return_exceptions=True
+            )
+    
+    for (_, _, future), result in zip(batch, results):
+        if future.done():
+            continue
+        if isinstance(result, BaseException):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
 
-        body = {
-            "model": "mistral-small-latest",
-            "messages": [{"role": "user", "content": prompt}],
-            "temperature": 0.7,
-            "max_tokens": 800,  # Reduced for speed
-            "stream": False
-        }
+async def _batch_worker():
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _batch_queue.get()]
+        deadline = loop.time() + MISTRAL_BATCH_WAIT_MS / 1000
+        while len(batch) < MISTRAL_MAX_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_batch_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # Network call di task terpisah agar batch berikutnya bisa langsung dikumpulkan
+        task = asyncio.create_task(_run_batch(batch))
+        _batch_tasks.add(task)
+        task.add_done_callback(_batch_tasks.discard)
 
-        async with session.post(
-            MISTRAL_URL, 
-            json=body, 
-            headers=headers, 
-            timeout=15  # Shorter timeout
-        ) as response:
-            data = await response.json()
-            return data["choices"][0]["message"]["content"]
-            
-    except asyncio.TimeoutError:
+async def batched_ask(prompt, client):
+    """Seperti _call_mistral, tapi digabung dengan prompt lain dalam window singkat"""
+    global _batch_queue, _batch_worker_task
+    if _batch_worker_task is None:
+        _batch_queue = asyncio.Queue()
+        _batch_worker_task = asyncio.create_task(_batch_worker())
+    
+    future = asyncio.get_running_loop().create_future()
+    await _batch_queue.put((prompt, client, future))
+    return await future
+
+async def stream_mistral(prompt, client, foods=None):
+    """Streaming Mistral (SSE): yield potongan teks begitu token tiba"""
+    if not MISTRAL_KEY:
+        yield get_fallback_response()
+        return
+    
+    key = _cache_key(prompt, foods)
+    cached = _exact.get(key) or await _redis_get(key)
+    if cached is not None:
+        yield cached
+        return
+    
+    parts = []
+    async with client.stream(
+        "POST", MISTRAL_URL, content=orjson.dumps(_request_body(prompt, stream=True))
+    ) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if not line.startswith("data: "):
+                continue
+            payload = line[6:]
+            if payload == "[DONE]":
+                break
+            delta = orjson.loads(payload)["choices"][0]["delta"].get("content")
+            if delta:
+                parts.append(delta)
+                yield delta
+    
+    # Stream lengkap -> simpan ke cache seperti jalur non-stream
+    result = "".join(parts)
+    if not _is_json_object(result):
+        return
+    _exact[key] = result
+    await _redis_set(key, result)
+
+async def _fetch_and_cache(prompt, client, key, semantic_text):
+    """Redis -> semantic cache -> network, lalu simpan hasil ke semua cache"""
+    cached = await _redis_get(key)
+    if cached is not None:
+        _exact[key] = cached
+        return cached
+    
+    vec = None
+    if load_semantic_cache():
+        vec = await asyncio.to_thread(_embed, semantic_text)
+        cached = _semantic_lookup(vec)
+        if cached is not None:
+            # Jawaban milik set makanan lain: jangan dipin di _exact untuk key ini
+            return cached
+
+    try:
+        if MISTRAL_BATCHING:
+            result = await batched_ask(prompt, client)
+        else:
+            result = await _call_mistral(prompt, client)
+    except httpx.TimeoutException:
         print("⏰ Mistral API timeout")
         return get_fallback_response()
     except Exception as e:
         print(f"❌ Mistral API error: {e}")
         return get_fallback_response()
 
-def ask_mistral(prompt):
-    """Sync version for compatibility"""
+    # Fallback tidak di-cache, hanya jawaban asli dari Mistral berupa objek JSON
+    if not _is_json_object(result):
+        print("❌ Mistral returned non-object JSON")
+        return get_fallback_response()
+    _exact[key] = result
+    await _redis_set(key, result)
+    if vec is not None:
+        _semantic_store(vec, result)
+    return result
+
+async def ask_mistral_async(prompt, client, foods=None):
+    """Async Mistral API call: exact cache -> singleflight -> network"""
     if not MISTRAL_KEY:
         return get_fallback_response()
     
-    # Run async function in event loop
+    key = _cache_key(prompt, foods)
+    cached = _exact.get(key)
+    if cached is not None:
+        return cached
+
+    # Request identik yang sedang berjalan cukup ditunggu, tidak dikirim ulang
+    task = _inflight.get(key)
+    if task is None:
+        # Semantic cache membandingkan daftar makanan, bukan prompt lengkap
+        semantic_text = _food_str(foods) if foods else prompt
+        task = asyncio.ensure_future(_fetch_and_cache(prompt, client, key, semantic_text))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    
+    # shield: caller yang dibatalkan tidak ikut membatalkan caller lain
+    return await asyncio.shield(task)
+
+def ask_mistral(prompt, foods=None):
+    """Sync version untuk caller non-async, lewat client HTTP/2 keep-alive"""
+    if not MISTRAL_KEY:
+        return get_fallback_response()
+    
+    key = _cache_key(prompt, foods)
+    cached = _exact.get(key)
+    if cached is not None:
+        return cached
+    
     try:
-        loop = asyncio.get_event_loop()
-    except RuntimeError:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+        response = _SESSION.post(MISTRAL_URL, content=orjson.dumps(_request_body(prompt)))
+        response.raise_for_status()
+        result = orjson.loads(response.content)["choices"][0]["message"]["content"]
+    except Exception as e:
+        print(f"❌ Mistral API error: {e}")
+        return get_fallback_response()
+    
+    if not _is_json_object(result):
+        print("❌ Mistral returned non-object JSON")
+        return get_fallback_response()
     
-    return loop.run_until_complete(ask_mistral_async(prompt))
+    _exact[key] = result
+    return result
 
 def test_mistral_connection():
     """Fast connection test"""
@@ -76,45 +404,37 @@ def test_mistral_connection():
     
     try:
         # Quick test dengan request kecil
-        headers = {
-            "Authorization": f"Bearer {MISTRAL_KEY}",
-            "Content-Type": "application/json"
-        }
-        
         body = {
             "model": "mistral-small-latest",
             "messages": [{"role": "user", "content": "Say OK"}],
             "max_tokens": 5
         }
         
-        response = requests.post(MISTRAL_URL, json=body, headers=headers, timeout=5)
+        response = _SESSION.post(MISTRAL_URL, content=orjson.dumps(body), timeout=5)
         response.raise_for_status()
         return "connected", "Mistral AI connection successful"
     except Exception as e:
         return "error", f"Mistral AI connection failed: {str(e)}"
 
+# Fallback dibangun dan di-serialize sekali saat import
+_FALLBACK = orjson.dumps({
+    "food_type": "Makanan Terdeteksi",
+    "components": ["Analisis cepat"],
+    "nutrition": {
+        "protein": "Cukup",
+        "carbs": "Cukup", 
+        "fat": "Cukup",
+        "fiber": "Cukup",
+        "vitamins": "Cukup"
+    },
+    "deficiencies": ["Perlu analisis lebih detail"],
+    "recommendations": [
+        "Konsumsi makanan seimbang",
+        "Perbanyak buah dan sayuran",
+        "Minum air yang cukup"
+    ]
+}).decode()
+
 def get_fallback_response():
     """Fast fallback response"""
-    return json.dumps({
-        "food_type": "Makanan Terdeteksi",
-        "components": ["Analisis cepat"],
-        "nutrition": {
-            "protein": "Cukup",
-            "carbs": "Cukup", 
-            "fat": "Cukup",
-            "fiber": "Cukup",
-            "vitamins": "Cukup"
-        },
-        "deficiencies": ["Perlu analisis lebih detail"],
-        "recommendations": [
-            "Konsumsi makanan seimbang",
-            "Perbanyak buah dan sayuran",
-            "Minum air yang cukup"
-        ]
-    })
-
-async def close_async_session():
-    """Close async session on shutdown"""
-    global async_session
-    if async_session:
-        await async_session.close()
\ No newline at end of file
+    return _FALLBACK
@@ -1,56 +1,32 @@
+# Prefix statis untuk system message Mistral.
+# INVARIAN: string ini harus byte-stable (spasi, urutan key, bahasa) agar
+# provider bisa memakai prompt caching untuk prefix. Jangan sisipkan data
+# dinamis di sini; semua yang berubah per request masuk ke user message.
+SYSTEM_PREFIX = (
+    "Kamu ahli gizi. Analisis makanan dari user: jenis, komponen utama, "
+    "estimasi gizi, kekurangan, dan 2 rekomendasi utama. "
+    "Jawab hanya JSON dengan format:\n"
+    '{"food_type":"string","components":["item"],'
+    '"nutrition":{"protein":"tinggi/sedang/rendah","carbs":"tinggi/sedang/rendah",'
+    '"fat":"tinggi/sedang/rendah","fiber":"tinggi/sedang/rendah","vitamins":"jenis vitamin"},'
+    '"deficiencies":["kekurangan"],"recommendations":["rekom1","rekom2"]}'
+)
+
 def build_comprehensive_prompt(food_list, detections):
-    """Optimized prompt untuk response cepat"""
+    """User message dinamis (makanan + deteksi); instruksi ada di SYSTEM_PREFIX"""
     
     if not food_list:
         food_list = ["Tidak ada makanan terdeteksi"]
     
-    food_str = ", ".join(food_list)
+    # Urutan deterministik: detected_foods berasal dari set
+    food_str = ", ".join(sorted(food_list))
     
     # Build detection details cepat
     detection_details = ""
     if detections and len(detections) > 0:
-        detection_details = "\nDeteksi: "
-        for det in detections[:3]:  # Hanya 3 teratas
-            detection_details += f"{det['label']}({det['confidence']:.1f}), "
-    
-    prompt = f"""
-ANALISIS CEPAT - FORMAT JSON
-
-Makanan: {food_str}
-{detection_details}
-
-Analisis cepat:
-- Jenis makanan
-- Komponen utama  
-- Estimasi gizi (protein, karbo, lemak, serat, vitamin)
-- 2 rekomendasi utama
-
-OUTPUT JSON:
-{{
-    "food_type": "string",
-    "components": ["item1", "item2"],
-    "nutrition": {{
-        "protein": "tinggi/sedang/rendah",
-        "carbs": "tinggi/sedang/rendah", 
-        "fat": "tinggi/sedang/rendah",
-        "fiber": "tinggi/sedang/rendah",
-        "vitamins": "jenis vitamin"
-    }},
-    "deficiencies": ["kekurangan1", "kekurangan2"],
-    "recommendations": ["rekom1", "rekom2"]
-}}
-
-Hanya JSON, tanpa penjelasan.
-"""
-
-    return prompt
-
-def build_simple_prompt(food_list):
-    """Super simple prompt untuk kecepatan maksimal"""
-    food_str = ", ".join(food_list) if food_list else "Tidak terdeteksi"
+        top = detections[:3]  # Hanya 3 teratas
+        detection_details = "\nDeteksi: " + ", ".join(
+            f"{det['label']}({det['confidence']:.1f})" for det in top
+        )
     
-    return f"""
-Makanan: {food_str}
-Analisis singkat: jenis, gizi utama, 1 saran.
-Format JSON singkat.
-"""
\ No newline at end of file
+    return f"Makanan: {food_str}{detection_details}"
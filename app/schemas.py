@@ -0,0 +1,30 @@
+from pydantic import BaseModel, ConfigDict
+
+class Detection(BaseModel):
+    """Satu bounding box hasil YOLO (koordinat gambar asli)"""
+    model_config = ConfigDict(extra="forbid")
+
+    label: str
+    confidence: float
+    bbox: list[int]
+    class_id: int
+
+class ProcessingTime(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    total: str
+    detection: str
+    upload: str
+
+class PredictResponse(BaseModel):
+    """Response /predict"""
+    model_config = ConfigDict(extra="forbid")
+
+    success: bool
+    filename: str
+    detected_foods: list[str]
+    detections: list[Detection]
+    nutrition_analysis: dict  # Bentuk bebas dari Mistral / fallback
+    analysis_source: str
+    processing_time: ProcessingTime
+    message: str
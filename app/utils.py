@@ -0,0 +1,68 @@
+import cv2
+import numpy as np
+import torch
+
+JPEG_MAGIC = b"\xff\xd8"
+
+def _exif_orientation(raw):
+    """Tag EXIF Orientation (1-8) dari segmen APP1 JPEG; 1 jika tidak ada"""
+    pos = 2
+    while pos + 4 <= len(raw) and raw[pos] == 0xFF:
+        marker = raw[pos + 1]
+        if marker == 0xDA:  # Start of Scan: header selesai
+            break
+        length = int.from_bytes(raw[pos + 2:pos + 4], "big")
+        segment = raw[pos + 4:pos + 2 + length]
+        if marker == 0xE1 and segment[:6] == b"Exif\0\0":
+            tiff = segment[6:]
+            order = "little" if tiff[:2] == b"II" else "big"
+            ifd = int.from_bytes(tiff[4:8], order)
+            count = int.from_bytes(tiff[ifd:ifd + 2], order)
+            for i in range(count):
+                entry = tiff[ifd + 2 + 12 * i:ifd + 14 + 12 * i]
+                if int.from_bytes(entry[:2], order) == 0x0112:
+                    value = int.from_bytes(entry[8:10], order)
+                    return value if 1 <= value <= 8 else 1
+            return 1
+        pos += 2 + length
+    return 1
+
+def _apply_exif_orientation(image, orientation):
+    """Putar/flip tensor CHW sesuai tag EXIF, sama seperti cv2.imdecode"""
+    h, w = 1, 2
+    if orientation == 2:
+        return image.flip(w)
+    if orientation == 3:
+        return image.rot90(2, (h, w))
+    if orientation == 4:
+        return image.flip(h)
+    if orientation == 5:
+        return image.transpose(h, w)
+    if orientation == 6:
+        return image.rot90(-1, (h, w))
+    if orientation == 7:
+        return image.rot90(2, (h, w)).transpose(h, w)
+    if orientation == 8:
+        return image.rot90(1, (h, w))
+    return image
+
+def _decode_jpeg_gpu(raw):
+    """Decode JPEG dengan nvjpeg langsung ke memory GPU (tensor CHW RGB uint8)"""
+    from torchvision.io import decode_jpeg, ImageReadMode
+    data = torch.frombuffer(bytearray(raw), dtype=torch.uint8)
+    # Paksa 3 channel: JPEG grayscale juga jadi RGB
+    image = decode_jpeg(data, mode=ImageReadMode.RGB, device="cuda")
+    # nvjpeg mengabaikan EXIF: putar manual agar frame sama dengan cv2.imdecode
+    return _apply_exif_orientation(image, _exif_orientation(raw)).contiguous()
+
+def decode_image(raw):
+    """Decode bytes gambar langsung ke ndarray BGR (atau tensor CUDA), tanpa lewat disk"""
+    # Di GPU, JPEG di-decode oleh nvjpeg: tidak ada decode CPU maupun copy H2D
+    if torch.cuda.is_available() and raw[:2] == JPEG_MAGIC:
+        try:
+            return _decode_jpeg_gpu(raw)
+        except Exception as e:
+            print(f"⚠️ nvjpeg decode failed, using OpenCV: {e}")
+    
+    arr = np.frombuffer(raw, np.uint8)
+    return cv2.imdecode(arr, cv2.IMREAD_COLOR)
@@ -3,150 +3,469 @@ import os
 import cv2
 import numpy as np
 import time
+import threading
+import torch
+
+MODEL_PATH = "models/best.pt"
+ENGINE_PATH = "models/best.engine"  # TensorRT FP16, hasil export_engine()
+ONNX_PATH = "models/best.onnx"
+ONNX_INT8_PATH = "models/best.int8.onnx"  # Static int8 (QDQ) untuk CPU, hasil export_onnx_int8()
+CALIB_DIR = "models/calib"  # Foto makanan asli untuk kalibrasi int8
+TRT_CACHE_DIR = "models/trt_cache"
+
+# Int8 opt-in: aktifkan hanya setelah benchmark + cek akurasi di CPU target
+YOLO_INT8 = os.getenv("YOLO_INT8") == "1"
+
+# FP16 untuk jalur PyTorch di GPU (default aktif, YOLO_FP16=0 untuk FP32);
+# engine TensorRT sudah FP16
+YOLO_FP16 = os.getenv("YOLO_FP16", "1") == "1"
 
 # Global model instance
 model = None
 model_loaded = False
+model_path = None
+LABELS = np.empty(0, dtype=object)  # class id -> nama, diisi saat load_model
+MODEL_READY = False  # True setelah warmup_model selesai
+_model_lock = threading.Lock()
+
+def export_engine():
+    """One-time export ke TensorRT FP16 engine (butuh GPU + TensorRT)"""
+    exported = YOLO(MODEL_PATH).export(
+        format="engine",
+        imgsz=320,      # Sama dengan ukuran inference
+        half=True,
+        dynamic=True,
+        batch=16,       # Sama dengan MAX_BATCH jalur batch
+    )
+    print(f"✅ TensorRT engine exported: {exported}")
+    return exported
+
+def export_onnx():
+    """One-time export ke ONNX float (CPU / CUDA tanpa TensorRT)"""
+    exported = YOLO(MODEL_PATH).export(
+        format="onnx",
+        imgsz=320,      # Sama dengan ukuran inference
+        simplify=True,
+        dynamic=True,   # Batch dinamis untuk jalur batch
+        half=False,
+    )
+    print(f"✅ ONNX model exported: {exported}")
+    return exported
+
+def export_onnx_int8():
+    """One-time static int8 quantization (QDQ) dari ONNX float, dikalibrasi dengan CALIB_DIR"""
+    import glob
+    from onnxruntime.quantization import (
+        CalibrationDataReader, QuantFormat, QuantType, quantize_static
+    )
+    
+    exported = export_onnx()
+    paths = sorted(glob.glob(os.path.join(CALIB_DIR, "*.jpg")))
+    if not paths:
+        raise FileNotFoundError(f"No calibration images (*.jpg) in {CALIB_DIR}")
+    
+    class _Reader(CalibrationDataReader):
+        """Satu gambar per langkah, preprocessing sama dengan jalur inference"""
+        def __init__(self):
+            self._paths = iter(paths)
+        
+        def get_next(self):
+            path = next(self._paths, None)
+            if path is None:
+                return None
+            padded, _ = _letterbox(cv2.imread(path))
+            return {"images": _to_blob([padded]).numpy()}
+    
+    quantize_static(
+        exported, ONNX_INT8_PATH, _Reader(),
+        quant_format=QuantFormat.QDQ,
+        per_channel=True,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+    )
+    print(f"✅ ONNX int8 model exported: {ONNX_INT8_PATH} ({len(paths)} calibration images)")
+    return ONNX_INT8_PATH
+
+def _select_model_path():
+    """GPU: engine TensorRT; lalu ONNX (int8 hanya di CPU + YOLO_INT8=1); selain itu bobot PyTorch"""
+    if torch.cuda.is_available():
+        if os.path.exists(ENGINE_PATH):
+            return ENGINE_PATH
+    elif YOLO_INT8 and os.path.exists(ONNX_INT8_PATH):
+        return ONNX_INT8_PATH
+    if os.path.exists(ONNX_PATH):
+        return ONNX_PATH
+    return MODEL_PATH
+
+def _onnx_providers():
+    """Execution provider terbaik yang tersedia, urut dari yang tercepat"""
+    import onnxruntime as ort
+    
+    preferred = [
+        ("TensorrtExecutionProvider", {
+            "trt_fp16_enable": True,
+            "trt_engine_cache_enable": True,  # Engine di-build sekali, lalu di-cache
+            "trt_engine_cache_path": TRT_CACHE_DIR,
+        }),
+        ("CUDAExecutionProvider", {}),
+        ("OpenVINOExecutionProvider", {}),  # Intel CPU: kernel int8 VNNI
+        ("CPUExecutionProvider", {}),
+    ]
+    available = set(ort.get_available_providers())
+    return [(name, options) for name, options in preferred if name in available]
+
+def _use_best_onnx_providers():
+    """Ganti session ONNX bawaan Ultralytics dengan provider terbaik"""
+    import onnxruntime as ort
+    
+    # AutoBackend versi baru hanya meneruskan *baca* atribut ke .backend;
+    # session harus diganti di objek backend aslinya
+    wrapper = getattr(model.predictor, "model", None)
+    backend = getattr(wrapper, "backend", wrapper)
+    if not model_path.endswith(".onnx") or getattr(backend, "session", None) is None:
+        return
+    
+    providers = _onnx_providers()
+    if [name for name, _ in providers] == backend.session.get_providers():
+        return
+    
+    session = ort.InferenceSession(model_path, providers=providers)
+    backend.session = session
+    backend.output_names = [x.name for x in session.get_outputs()]
+    backend.dynamic = isinstance(session.get_outputs()[0].shape[0], str)
+    
+    # IO binding terikat ke session lama: bind ulang ke tensor output yang sama
+    if getattr(backend, "use_io_binding", False):
+        backend.io = session.io_binding()
+        for output, y in zip(session.get_outputs(), backend.bindings):
+            backend.io.bind_output(
+                name=output.name,
+                device_type=y.device.type,
+                device_id=y.device.index or 0,
+                element_type=torch.empty(0, dtype=y.dtype).numpy().dtype,
+                shape=tuple(y.shape),
+                buffer_ptr=y.data_ptr(),
+            )
+    print(f"⚙️ ONNX providers: {backend.session.get_providers()}")
+
+def _fp16_supported():
+    """GPU dengan tensor core (compute capability >= 7.0)"""
+    return torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 7
 
 def load_model():
-    """Load model dengan optimasi"""
-    global model, model_loaded
+    """Load model sekali (lazy, thread-safe) dengan optimasi"""
+    global model, model_loaded, model_path, LABELS
     
     if model_loaded:
         return model
     
-    MODEL_PATH = "models/best.pt"
-    
-    try:
-        print("⚡ Loading optimized YOLO model...")
-        model = YOLO(MODEL_PATH)
-        
-        # Set optimal inference parameters
-        model.overrides['conf'] = 0.25      # Confidence threshold
-        model.overrides['iou'] = 0.45       # IOU threshold
-        model.overrides['imgsz'] = 320      # Optimized image size
-        model.overrides['agnostic_nms'] = False
-        model.overrides['max_det'] = 10     # Max detections
-        model.overrides['verbose'] = False  # Disable logging
+    with _model_lock:
+        # Cek ulang: thread lain mungkin sudah load selama menunggu lock
+        if model_loaded:
+            return model
         
-        model_loaded = True
-        print(f"✅ Model loaded with {len(model.names)} classes")
+        path = _select_model_path()
         
-        return model
-        
-    except Exception as e:
-        print(f"❌ Model loading failed: {e}")
-        raise e
+        try:
+            print(f"⚡ Loading optimized YOLO model ({path})...")
+            loaded = YOLO(path, task="detect")
+            
+            # Gabungkan Conv+BN (hanya untuk bobot PyTorch, hasil export sudah fused)
+            if path == MODEL_PATH:
+                loaded.fuse()
+            
+            # Set optimal inference parameters
+            loaded.overrides['conf'] = 0.25      # Confidence threshold
+            loaded.overrides['iou'] = 0.45       # IOU threshold
+            loaded.overrides['imgsz'] = 320      # Optimized image size
+            loaded.overrides['agnostic_nms'] = False
+            loaded.overrides['max_det'] = 10     # Max detections
+            loaded.overrides['verbose'] = False  # Disable logging
+            
+            # Half precision: Ultralytics men-cast model dan input ke FP16
+            if path == MODEL_PATH and YOLO_FP16 and _fp16_supported():
+                loaded.overrides['half'] = True
+            
+            # Nama kelas sebagai array: lookup label per box jadi satu gather NumPy
+            LABELS = np.array(
+                [loaded.names[i] for i in range(len(loaded.names))], dtype=object
+            )
+            
+            model = loaded
+            model_path = path
+            model_loaded = True
+            print(f"✅ Model loaded with {len(model.names)} classes")
+            
+            return model
+            
+        except Exception as e:
+            print(f"❌ Model loading failed: {e}")
+            raise e
 
-def warmup_model():
-    """Warm up model dengan inference sample"""
-    model = load_model()
-    # Warm up dengan sample image
-    sample_image = np.ones((320, 320, 3), dtype=np.uint8) * 255
-    _ = model(sample_image, verbose=False)
-    print("🔥 Model warmed up!")
+def warmup_model(batch_sizes=(1,), runs=3):
+    """Warm up model sekali saat startup (cuDNN autotune per ukuran batch)"""
+    global MODEL_READY
+    if torch.cuda.is_available():
+        torch.backends.cudnn.benchmark = True
+    
+    load_model()
+    # Warm up lewat jalur batch yang sama dengan request asli
+    sample_image = np.full((INPUT_SIZE, INPUT_SIZE, 3), 255, dtype=np.uint8)
+    
+    # Predictor baru ada setelah inference pertama; lalu pilih provider ONNX
+    detect_food_batch([sample_image])
+    _use_best_onnx_providers()
+    
+    for batch_size in batch_sizes:
+        for _ in range(runs):
+            detect_food_batch([sample_image] * batch_size)
+    
+    MODEL_READY = True
+    print(f"🔥 Model warmed up! (fp16={is_fp16()})")
+
+def is_fp16():
+    """True jika backend aktif berjalan di FP16"""
+    predictor = getattr(model, "predictor", None)
+    return bool(predictor and getattr(predictor.model, "fp16", False))
+
+def _load_image(image, flags=cv2.IMREAD_COLOR):
+    """Terima ndarray BGR / tensor CUDA RGB (in-memory) atau path file (legacy)"""
+    if isinstance(image, (np.ndarray, torch.Tensor)):
+        return image
+    return cv2.imread(image, flags)
+
+# Parameter inference yang dipakai jalur single maupun batch
+INFER_PARAMS = dict(
+    conf=0.2,           # Lower confidence for more detections
+    iou=0.4,            # Slightly lower IOU
+    imgsz=320,          # Fixed optimized size
+    augment=False,      # No augmentation for speed
+    verbose=False,      # No logging
+    max_det=8,          # Limit detections
+)
 
-def detect_food_optimized(image_path):
+MAX_BATCH = 16  # Sweet spot batch size untuk satu forward pass
+INPUT_SIZE = INFER_PARAMS["imgsz"]
+LETTERBOX_COLOR = (114, 114, 114)  # Padding standar Ultralytics
+
+def _letterbox(image, size=INPUT_SIZE):
+    """Resize dengan aspect ratio tetap + padding ke size x size"""
+    h, w = image.shape[:2]
+    ratio = min(size / h, size / w)
+    new_w, new_h = round(w * ratio), round(h * ratio)
+    interpolation = cv2.INTER_AREA if ratio < 1 else cv2.INTER_LINEAR
+    resized = cv2.resize(image, (new_w, new_h), interpolation=interpolation)
+    
+    left = (size - new_w) // 2
+    top = (size - new_h) // 2
+    padded = cv2.copyMakeBorder(
+        resized, top, size - new_h - top, left, size - new_w - left,
+        cv2.BORDER_CONSTANT, value=LETTERBOX_COLOR
+    )
+    return padded, (ratio, left, top)
+
+def _letterbox_gpu(image, size=INPUT_SIZE):
+    """Letterbox tensor CHW uint8 RGB langsung di GPU, hasil float [0, 1]"""
+    _, h, w = image.shape
+    ratio = min(size / h, size / w)
+    new_w, new_h = round(w * ratio), round(h * ratio)
+    
+    x = image.unsqueeze(0).float().div_(255)
+    x = torch.nn.functional.interpolate(
+        x, size=(new_h, new_w), mode="bilinear", align_corners=False, antialias=ratio < 1
+    )
+    left = (size - new_w) // 2
+    top = (size - new_h) // 2
+    x = torch.nn.functional.pad(
+        x, (left, size - new_w - left, top, size - new_h - top),
+        value=LETTERBOX_COLOR[0] / 255
+    )
+    return x[0], (ratio, left, top)
+
+def _to_blob(images):
+    """Scale 1/255 + BGR->RGB + NHWC->NCHW dalam satu pass SIMD OpenCV"""
+    blob = cv2.dnn.blobFromImages(
+        images, 1 / 255.0, (INPUT_SIZE, INPUT_SIZE), swapRB=True, crop=False
+    )
+    return torch.from_numpy(blob)
+
+# Staging buffer pinned untuk H2D async (dibuat saat pertama dipakai)
+_pinned = None
+_copy_done = None
+_gpu_lock = threading.Lock()
+
+def _to_device(batch):
+    """Copy batch ke GPU lewat pinned memory, dtype mengikuti presisi backend"""
+    global _pinned, _copy_done
+    if not torch.cuda.is_available():
+        return batch
+    
+    # FP32 deployment tetap FP32; FP16 cukup kirim setengah byte lewat PCIe.
+    # Predictor belum ada sebelum inference pertama: buffer dibuat ulang sekali
+    dtype = torch.float16 if is_fp16() else torch.float32
+    if _pinned is None or _pinned.dtype != dtype:
+        _pinned = torch.empty(
+            (MAX_BATCH, 3, INPUT_SIZE, INPUT_SIZE),
+            dtype=dtype,
+            pin_memory=True
+        )
+    
+    # Pastikan copy sebelumnya selesai sebelum buffer ditimpa
+    if _copy_done is not None:
+        _copy_done.synchronize()
+    staging = _pinned[:batch.shape[0]]
+    staging.copy_(batch)
+    
+    # Satu worker + _gpu_lock sudah men-serialize copy dan compute, jadi
+    # copy jalan di stream compute (urutan terjamin, tanpa stream terpisah)
+    gpu_batch = staging.to("cuda", non_blocking=True)
+    _copy_done = torch.cuda.Event()
+    _copy_done.record()
+    return gpu_batch
+
+def _boxes_soa(r, original_shape, letterbox):
+    """Box sebagai SoA (xyxy, conf, cls), sudah difilter + diurutkan by confidence"""
+    ratio, pad_x, pad_y = letterbox
+    height, width = original_shape[:2]
+    
+    # Satu transfer device->host untuk semua box: [x1, y1, x2, y2, conf, cls]
+    data = r.boxes.data.cpu().numpy() if r.boxes is not None else np.empty((0, 6))
+    
+    # Skip jika confidence terlalu rendah, lalu urutkan descending
+    conf = data[:, 4]
+    keep = np.flatnonzero(conf >= 0.15)
+    order = keep[np.argsort(-conf[keep])]
+    data = data[order]
+    
+    # Kembalikan bbox dari ruang letterbox ke gambar asli (vectorized)
+    xyxy = (data[:, :4] - (pad_x, pad_y, pad_x, pad_y)) / ratio
+    np.clip(xyxy, 0, (width, height, width, height), out=xyxy)
+    
+    return xyxy.astype(np.int32), data[:, 4], data[:, 5].astype(np.int32)
+
+def _parse_result(r, model, start_time, original_shape, letterbox):
+    """Konversi satu hasil YOLO ke dict response (bbox di koordinat asli)"""
+    xyxy, conf, cls = _boxes_soa(r, original_shape, letterbox)
+    
+    # Dict hanya dibangun di sini, untuk response API
+    labels = LABELS[cls].tolist()
+    detections = [
+        {
+            "label": label,
+            "confidence": confidence,
+            "bbox": bbox,
+            "class_id": class_id
+        }
+        for label, confidence, bbox, class_id
+        in zip(labels, conf.tolist(), xyxy.tolist(), cls.tolist())
+    ]
+    
+    processing_time = time.time() - start_time
+    
+    return {
+        "detected_foods": list(set(labels)),
+        "detections": detections,
+        "total_detections": len(detections),
+        "processing_time": f"{processing_time:.3f}s",
+        "image_size": original_shape
+    }
+
+DEADLINE_EXCEEDED = "deadline exceeded"  # error di empty_result untuk request yang kedaluwarsa
+
+def detect_food_optimized(image, deadline_ts=None):
     """Optimized food detection dengan speed focus"""
+    # Client sudah menyerah: jangan habiskan compute untuk inference
+    if deadline_ts is not None and time.monotonic() > deadline_ts:
+        return empty_result(DEADLINE_EXCEEDED)
+    return detect_food_batch([image])[0]
+
+def detect_food_batch(images):
+    """Batched detection: satu forward pass per MAX_BATCH gambar"""
     start_time = time.time()
+    outputs = [None] * len(images)
     
-    try:
-        # Load image dengan optimasi
-        image = cv2.imread(image_path)
+    # Gambar yang gagal di-decode tidak ikut batch
+    valid = []
+    for i, image in enumerate(images):
+        image = _load_image(image) if image is not None else None
         if image is None:
-            return empty_result("Cannot read image")
-        
-        # Resize image jika terlalu besar (speed optimization)
-        original_shape = image.shape
-        if max(image.shape) > 640:
-            scale = 640 / max(image.shape)
-            new_size = (int(image.shape[1] * scale), int(image.shape[0] * scale))
-            image = cv2.resize(image, new_size, interpolation=cv2.INTER_LINEAR)
-        
-        # Load model jika belum loaded
+            outputs[i] = empty_result("Cannot read image")
+        elif isinstance(image, torch.Tensor):
+            # Hasil nvjpeg (CHW RGB di GPU): letterbox tanpa keluar dari device
+            _, h, w = image.shape
+            prepared, letterbox = _letterbox_gpu(image)
+            valid.append((i, (h, w, 3), letterbox, prepared))
+        else:
+            padded, letterbox = _letterbox(image)
+            valid.append((i, image.shape, letterbox, padded))
+    
+    try:
         model = load_model()
-        
-        # Ultra-fast inference dengan optimized parameters
-        results = model(
-            image, 
-            conf=0.2,           # Lower confidence for more detections
-            iou=0.4,            # Slightly lower IOU
-            imgsz=320,          # Fixed optimized size
-            augment=False,      # No augmentation for speed
-            verbose=False,      # No logging
-            max_det=8,          # Limit detections
-        )
-        
-        detections = []
-        detected_foods = set()
-        
-        for r in results:
-            boxes = r.boxes
-            if boxes is not None and len(boxes) > 0:
-                for box in boxes:
-                    confidence = float(box.conf[0])
-                    class_id = int(box.cls[0])
-                    label = model.names[class_id]
-                    
-                    # Skip jika confidence terlalu rendah
-                    if confidence < 0.15:
-                        continue
-                    
-                    # Fast bbox conversion
-                    x1, y1, x2, y2 = map(int, box.xyxy[0])
-                    
-                    detection = {
-                        "label": label,
-                        "confidence": confidence,
-                        "bbox": [x1, y1, x2, y2],
-                        "class_id": class_id
-                    }
-                    
-                    detections.append(detection)
-                    detected_foods.add(label)
-        
-        # Fast sorting
-        detections.sort(key=lambda x: x["confidence"], reverse=True)
-        
-        processing_time = time.time() - start_time
-        
-        return {
-            "detected_foods": list(detected_foods),
-            "detections": detections,
-            "total_detections": len(detections),
-            "processing_time": f"{processing_time:.3f}s",
-            "image_size": original_shape
-        }
-        
+        for offset in range(0, len(valid), MAX_BATCH):
+            chunk = valid[offset:offset + MAX_BATCH]
+            with _gpu_lock:
+                results = model(_build_batch([item[3] for item in chunk]), **INFER_PARAMS)
+            for (i, original_shape, letterbox, _), r in zip(chunk, results):
+                outputs[i] = _parse_result(
+                    r, model, start_time, original_shape, letterbox
+                )
     except Exception as e:
         print(f"❌ Detection error: {e}")
-        return empty_result(str(e))
+        for i, *_ in valid:
+            if outputs[i] is None:
+                outputs[i] = empty_result(str(e))
+    
+    return outputs
+
+def _build_batch(items):
+    """Gabungkan ndarray letterbox (CPU) dan tensor GPU jadi satu batch NCHW"""
+    cpu_items = [item for item in items if isinstance(item, np.ndarray)]
+    if len(cpu_items) == len(items):
+        return _to_device(_to_blob(cpu_items))
+    
+    # Campuran: blob CPU dikirim ke GPU lalu disusun ulang sesuai urutan asli
+    cpu_rows = iter(_to_device(_to_blob(cpu_items))) if cpu_items else iter(())
+    gpu_dtype = _pinned.dtype if cpu_items else torch.float32
+    return torch.stack([
+        next(cpu_rows) if isinstance(item, np.ndarray) else item.to(gpu_dtype)
+        for item in items
+    ])
 
-def detect_food_ultrafast(image_path):
+# Buffer resize per thread untuk jalur ultrafast (dipakai ulang tiap panggilan)
+_TLS = threading.local()
+
+def _resize_buffer():
+    buf = getattr(_TLS, "buf", None)
+    if buf is None:
+        buf = _TLS.buf = np.empty((INPUT_SIZE, INPUT_SIZE, 3), dtype=np.uint8)
+    return buf
+
+def detect_food_ultrafast(image):
     """Ultra-fast detection untuk real-time applications"""
     try:
-        # Load image in grayscale for speed (convert back to BGR)
-        image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+        # Tetap warna (model dilatih di BGR); dari file, libjpeg langsung
+        # men-decode di 1/2 resolusi lewat IDCT yang diperkecil
+        image = _load_image(image, cv2.IMREAD_REDUCED_COLOR_2)
         if image is None:
             return empty_result("Cannot read image")
         
-        # Convert to BGR (YOLO expects 3 channels)
-        image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
-        
-        # Resize to fixed small size
-        image = cv2.resize(image, (320, 320), interpolation=cv2.IMREAD_GRAYSCALE)
+        # Resize to fixed small size (INTER_AREA: cepat + bagus untuk downscale),
+        # ditulis in-place ke buffer thread ini tanpa alokasi baru
+        image = cv2.resize(
+            image, (INPUT_SIZE, INPUT_SIZE), dst=_resize_buffer(),
+            interpolation=cv2.INTER_AREA
+        )
         
         model = load_model()
         
         # Minimal inference
-        results = model(image, conf=0.25, imgsz=320, verbose=False, max_det=3)
+        results = model(image, conf=0.25, imgsz=INPUT_SIZE, verbose=False, max_det=3)
         
+        # Satu transfer untuk semua class id, bukan sync per box
         detected_foods = set()
         for r in results:
             if r.boxes is not None:
-                for cls_id in r.boxes.cls:
-                    label = model.names[int(cls_id)]
-                    detected_foods.add(label)
+                detected_foods.update(LABELS[r.boxes.cls.int().cpu().numpy()].tolist())
         
         return {
             "detected_foods": list(detected_foods),
@@ -173,18 +492,29 @@ def get_model_info():
     """Get model information"""
     model = load_model()
     return {
-        "model_path": "models/best.pt",
+        "model_path": model_path,
+        "fp16": is_fp16(),
         "classes_count": len(model.names),
         "classes": list(model.names.values())[:10],  # First 10 only
         "input_size": 320,
         "optimized": True,
-        "status": "loaded" if model_loaded else "loading"
+        "status": "ready" if MODEL_READY else ("loaded" if model_loaded else "loading")
     }
 
 # Legacy function untuk compatibility
-def detect_food(image_path):
-    result = detect_food_optimized(image_path)
+def detect_food(image):
+    result = detect_food_optimized(image)
     return result["detected_foods"]
 
-def detect_food_with_details(image_path):
-    return detect_food_optimized(image_path)
\ No newline at end of file
+def detect_food_with_details(image):
+    return detect_food_optimized(image)
+
+if __name__ == "__main__":
+    import sys
+    # python -m app.yolo_detector [engine|onnx|onnx-int8]
+    if sys.argv[1:] == ["onnx"]:
+        export_onnx()
+    elif sys.argv[1:] == ["onnx-int8"]:
+        export_onnx_int8()
+    else:
+        export_engine()
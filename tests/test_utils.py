@@ -0,0 +1,59 @@
+import io
+
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip("cv2")
+torch = pytest.importorskip("torch")
+Image = pytest.importorskip("PIL.Image")
+
+from app.utils import _apply_exif_orientation, _exif_orientation, decode_image
+
+
+def _jpeg(orientation, size=(100, 40)):
+    """JPEG 100x40 (lebar x tinggi) dengan gradien horizontal dan tag Orientation"""
+    gradient = np.tile(np.linspace(0, 255, size[0], dtype=np.uint8), (size[1], 1))
+    image = Image.fromarray(np.dstack([gradient] * 3))
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    buf = io.BytesIO()
+    image.save(buf, format="JPEG", quality=95, exif=exif)
+    return buf.getvalue()
+
+
+@pytest.mark.parametrize("orientation", range(1, 9))
+def test_exif_orientation_tag(orientation):
+    assert _exif_orientation(_jpeg(orientation)) == orientation
+
+
+def test_exif_orientation_missing():
+    buf = io.BytesIO()
+    Image.new("RGB", (8, 8)).save(buf, format="JPEG")
+    assert _exif_orientation(buf.getvalue()) == 1
+
+
+@pytest.mark.parametrize("orientation", range(1, 9))
+def test_apply_exif_orientation_matches_opencv(orientation):
+    decode_jpeg = pytest.importorskip("torchvision.io").decode_jpeg
+    raw = _jpeg(orientation)
+
+    expected = cv2.imdecode(np.frombuffer(raw, np.uint8), cv2.IMREAD_COLOR)
+    tensor = decode_jpeg(torch.frombuffer(bytearray(raw), dtype=torch.uint8))
+    rotated = _apply_exif_orientation(tensor, orientation).permute(1, 2, 0).numpy()
+
+    assert rotated.shape == expected.shape
+    # Gradien harus mengarah ke sisi yang sama (toleransi artefak JPEG)
+    diff = np.abs(rotated[..., 0].astype(int) - expected[..., 2].astype(int))
+    assert diff.mean() < 8
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="butuh CUDA + nvjpeg")
+def test_gpu_decode_matches_cpu_orientation():
+    raw = _jpeg(6)
+
+    cpu = cv2.imdecode(np.frombuffer(raw, np.uint8), cv2.IMREAD_COLOR)
+    gpu = decode_image(raw)
+
+    assert isinstance(gpu, torch.Tensor)
+    assert cpu.shape == (100, 40, 3)
+    assert tuple(gpu.shape[1:]) == cpu.shape[:2]